@@ -0,0 +1,34 @@
+from typing import Dict, Iterable, Optional
+from cachetools import TTLCache
+import httpx
+from .config import settings
+
+# hospital_id -> hospital JSON from the Render backend.
+# Only touched from the event loop with no await between read and write,
+# so no lock is needed.
+_cache: TTLCache = TTLCache(maxsize=settings.HOSPITAL_CACHE_SIZE, ttl=settings.HOSPITAL_CACHE_TTL)
+
+async def get_hospital(client: httpx.AsyncClient, hospital_id) -> Optional[Dict]:
+    """
+    Fetch a hospital from the Render backend, serving repeat lookups from the TTL cache.
+    Returns None if the upstream does not return the hospital.
+    """
+    key = str(hospital_id)
+    hospital = _cache.get(key)
+    if hospital is not None:
+        return hospital
+
+    res = await client.get(f"/hospitals/{hospital_id}")
+    if res.status_code != 200:
+        return None
+
+    hospital = res.json()
+    _cache[key] = hospital
+    return hospital
+
+def invalidate(hospital_ids: Iterable) -> None:
+    """
+    Drop cached entries for hospitals that were changed or deleted upstream.
+    """
+    for hid in hospital_ids:
+        _cache.pop(str(hid), None)
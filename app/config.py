@@ -5,7 +5,22 @@ class Settings(BaseSettings):
     HOSPITAL_API_BASE: str = "https://hospital-directory.onrender.com"
 
     MAX_CSV_ROWS: int = 20
-    CONCURRENCY: int = 5
+    MAX_CSV_BYTES: int = 2 * 1024 * 1024
+    MAX_CSV_RECORD_BYTES: int = 64 * 1024  # one row, including quoted newlines
+    CONCURRENCY: int = 20  # HTTP/2 streams on one connection are cheap
     HTTP_TIMEOUT: int = 10  # seconds
+    HTTP_CONNECT_TIMEOUT: int = 5  # seconds
+    HTTP_CONNECT_RETRIES: int = 3
+    HTTP_POST_ATTEMPTS: int = 3
+    BULK_RETRY_INTERVAL: int = 300  # seconds before probing a missing bulk endpoint again
+
+    # Shared upstream connection pool
+    HTTP2: bool = True
+    MAX_CONNECTIONS: int = 100
+    MAX_KEEPALIVE_CONNECTIONS: int = 20
+
+    # GET /hospitals/{id} cache
+    HOSPITAL_CACHE_SIZE: int = 10_000
+    HOSPITAL_CACHE_TTL: int = 30  # seconds
 
 settings = Settings()
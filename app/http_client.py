@@ -0,0 +1,67 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Iterable, List
+from fastapi import FastAPI, Request
+import httpx
+from .config import settings
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open a single pooled AsyncClient for the lifetime of the app so every
+    upstream call reuses keep-alive connections to the Render backend.
+    With HTTP/2 the concurrent calls are multiplexed over one connection.
+    """
+    # With an explicit transport, pool limits and HTTP/2 are set on the
+    # transport; the client ignores them. retries= re-attempts failed connects.
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_keepalive_connections=settings.MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=settings.MAX_CONNECTIONS,
+        ),
+        http2=settings.HTTP2,
+        retries=settings.HTTP_CONNECT_RETRIES,
+    )
+    app.state.client = httpx.AsyncClient(
+        base_url=settings.HOSPITAL_API_BASE,
+        timeout=httpx.Timeout(settings.HTTP_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+        transport=transport,
+    )
+    # Pushed forward by process_rows when the upstream shows it has no bulk endpoint.
+    app.state.bulk_retry_at = 0.0
+    try:
+        yield
+    finally:
+        await app.state.client.aclose()
+
+
+def get_client(request: Request) -> httpx.AsyncClient:
+    """
+    FastAPI dependency returning the shared upstream client.
+    """
+    return request.app.state.client
+
+
+async def gather_bounded(aws: Iterable[Awaitable], return_exceptions: bool = False) -> List:
+    """
+    Run upstream calls concurrently, at most settings.CONCURRENCY at a time.
+    Results come back in the same order as the awaitables.
+    """
+    sem = asyncio.Semaphore(settings.CONCURRENCY)
+
+    async def bounded(aw: Awaitable):
+        async with sem:
+            return await aw
+
+    return await asyncio.gather(*(bounded(aw) for aw in aws), return_exceptions=return_exceptions)
+
+
+def raise_first_error(results: List) -> None:
+    """
+    Re-raise the first exception in gather_bounded(..., return_exceptions=True)
+    results, once every call has finished.
+    """
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
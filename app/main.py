@@ -1,14 +1,34 @@
 import uuid
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from .processor import parse_csv_bytes, process_rows
+from typing import Any, Optional
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from .processor import CSVTooLarge, stream_csv, process_rows
 from .storage import save_batch, get_batch, get_all_batches, remove_batch
-from .schemas import BulkResponse, HospitalResult
+from .schemas import BulkResponse, HospitalResult, ActivatePayload
 from .config import settings
+from .http_client import lifespan, get_client, gather_bounded, raise_first_error
+from .cache import get_hospital, invalidate
 import httpx
+import orjson
 
-app = FastAPI(title="Hospital Management Backend", version="1.0")
 
-RENDER_BASE = settings.HOSPITAL_API_BASE
+class ORJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson. Used as the app default for handlers
+    that return plain dicts/lists (batch listings, upstream hospital JSON).
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+app = FastAPI(
+    title="Hospital Management Backend",
+    version="1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 @app.get("/")
@@ -21,10 +41,29 @@ def root():
 # ---------------------------------------------------------
 
 @app.get("/hospitals")
-async def list_hospitals():
-    async with httpx.AsyncClient() as client:
-        res = await client.get(f"{RENDER_BASE}/hospitals/")
-        return res.json()
+async def list_hospitals(request: Request, client: httpx.AsyncClient = Depends(get_client)):
+    # Stream the upstream body straight through so memory stays at one chunk
+    # however large the hospital list grows. The raw bytes are passed on as
+    # is, so ask the upstream only for encodings the caller accepts.
+    req = client.build_request(
+        "GET",
+        "/hospitals/",
+        headers={"accept-encoding": request.headers.get("accept-encoding", "identity")},
+    )
+    res = await client.send(req, stream=True)
+
+    # Raw bytes are still in the upstream encoding (e.g. gzip), so say so.
+    headers = {}
+    if "content-encoding" in res.headers:
+        headers["content-encoding"] = res.headers["content-encoding"]
+
+    return StreamingResponse(
+        res.aiter_raw(),
+        status_code=res.status_code,
+        media_type=res.headers.get("content-type", "application/json"),
+        headers=headers,
+        background=BackgroundTask(res.aclose),
+    )
 
 
 # ---------------------------------------------------------
@@ -33,12 +72,12 @@ async def list_hospitals():
 
 
 @app.delete("/hospitals/{hospital_id}")
-async def delete_hospital(hospital_id: str):
-    async with httpx.AsyncClient() as client:
-        res = await client.delete(f"{RENDER_BASE}/hospitals/{hospital_id}")
-        if res.status_code == 404:
-            raise HTTPException(404, "Hospital not found")
-        return {"deleted": True}
+async def delete_hospital(hospital_id: str, client: httpx.AsyncClient = Depends(get_client)):
+    res = await client.delete(f"/hospitals/{hospital_id}")
+    invalidate([hospital_id])
+    if res.status_code == 404:
+        raise HTTPException(404, "Hospital not found")
+    return {"deleted": True}
 
 
 # ---------------------------------------------------------
@@ -46,135 +85,151 @@ async def delete_hospital(hospital_id: str):
 # ---------------------------------------------------------
 
 @app.post("/hospitals/bulk/upload", response_model=BulkResponse)
-async def bulk_upload(file: UploadFile = File(...)):
+async def bulk_upload(request: Request, file: UploadFile = File(...), client: httpx.AsyncClient = Depends(get_client)):
     if not file.filename.lower().endswith(".csv"):
         raise HTTPException(status_code=400, detail="Only CSV files allowed.")
 
-    file_bytes = await file.read()
-    rows = await parse_csv_bytes(file_bytes)
+    # Parse while reading so an oversized upload is rejected at the first extra row.
+    rows = []
+    try:
+        async for row in stream_csv(file):
+            rows.append(row)
+            if len(rows) > settings.MAX_CSV_ROWS:
+                raise HTTPException(400, f"Max rows allowed: {settings.MAX_CSV_ROWS}")
+    except CSVTooLarge as e:
+        raise HTTPException(400, str(e))
 
     if len(rows) == 0:
         raise HTTPException(400, "CSV contains no valid rows")
 
-    if len(rows) > settings.MAX_CSV_ROWS:
-        raise HTTPException(400, f"Max rows allowed: {settings.MAX_CSV_ROWS}")
-
     batch_id = str(uuid.uuid4())
 
-    results, activated, processing_time = await process_rows(rows, batch_id)
+    results, activated, processing_time = await process_rows(client, rows, batch_id, request.app.state)
 
     # Extract created hospital IDs
     created_ids = [r.hospital_id for r in results if r.status == "created"]
 
     # Save batch mapping
-    await save_batch(batch_id, created_ids)
+    save_batch(batch_id, created_ids)
 
-    # Build API response
-    return BulkResponse(
+    # Build API response; every field is produced here, so skip validation
+    response = BulkResponse.model_construct(
         batch_id=batch_id,
         total_hospitals=len(rows),
         processed_hospitals=len(created_ids),
         failed_hospitals=len(rows) - len(created_ids),
         processing_time_seconds=processing_time,
         batch_activated=activated,
-        hospitals=[r for r in results]
+        hospitals=results
     )
 
+    # Serialise straight to JSON bytes; response_model is kept for the OpenAPI schema.
+    return Response(response.model_dump_json(), media_type="application/json")
+
 
 # ---------------------------------------------------------
 # BATCH DETAILS — FETCH FROM RENDER BACKEND
 # ---------------------------------------------------------
 
 @app.get("/hospitals/batch/{batch_id}")
-async def batch_details(batch_id: str):
-    ids = await get_batch(batch_id)
+async def batch_details(batch_id: str, client: httpx.AsyncClient = Depends(get_client)):
+    ids = get_batch(batch_id)
     if not ids:
         raise HTTPException(404, "Batch not found")
 
-    hospitals = []
-    async with httpx.AsyncClient() as client:
-        for hid in ids:
-            res = await client.get(f"{RENDER_BASE}/hospitals/{hid}")
-            if res.status_code == 200:
-                hospitals.append(res.json())
+    responses = await gather_bounded(
+        (get_hospital(client, hid) for hid in ids),
+        return_exceptions=True,
+    )
+    # upstream errors surface as before; only missing hospitals are dropped
+    raise_first_error(responses)
+    hospitals = [h for h in responses if h is not None]
 
     return hospitals
 
 
 # ---------------------------------------------------------
-# BATCH ACTIVATE
+# BATCH ACTIVATE / DEACTIVATE
 # ---------------------------------------------------------
 
 @app.patch("/hospitals/batch/{batch_id}/activate")
-async def activate_batch(batch_id: str):
-    async with httpx.AsyncClient() as client:
-        res = await client.patch(f"{RENDER_BASE}/hospitals/batch/{batch_id}/activate")
+async def activate_batch(
+    batch_id: str,
+    body: Optional[ActivatePayload] = None,
+    client: httpx.AsyncClient = Depends(get_client),
+):
+    """
+    Activate a batch, or deactivate it when the body is {"active": false}.
+    Both go through the same activate endpoint on the Render backend.
+    """
+    active = body.active if body is not None else True
+
+    res = await client.patch(
+        f"/hospitals/batch/{batch_id}/activate",
+        json={"active": active}
+    )
+    invalidate(get_batch(batch_id) or [])
+
+    if active:
         return {"batch_id": batch_id, "activated": res.status_code in (200, 204)}
 
+    if res.status_code not in (200, 204):
+        raise HTTPException(400, f"Failed to deactivate batch: {res.text}")
+
+    return {"batch_id": batch_id, "deactivated": True}
+
 
 # ---------------------------------------------------------
 # BATCH DELETE
 # ---------------------------------------------------------
 
 @app.delete("/hospitals/batch/{batch_id}")
-async def delete_batch(batch_id: str):
-    ids = await get_batch(batch_id)
+async def delete_batch(batch_id: str, client: httpx.AsyncClient = Depends(get_client)):
+    ids = get_batch(batch_id)
     if not ids:
         raise HTTPException(404, "Batch not found")
 
-    # delete hospitals in Render
-    async with httpx.AsyncClient() as client:
-        for hid in ids:
-            await client.delete(f"{RENDER_BASE}/hospitals/{hid}")
+    # delete hospitals in Render; keep the local mapping if any call errored
+    responses = await gather_bounded(
+        (client.delete(f"/hospitals/{hid}") for hid in ids),
+        return_exceptions=True,
+    )
+    invalidate(ids)
+    raise_first_error(responses)
 
     # remove batch locally
-    await remove_batch(batch_id)
+    remove_batch(batch_id)
 
     return {"batch_id": batch_id, "deleted": True}
 
 
 @app.get("/hospitals/batches")
-async def list_batches():
-    batches = await get_all_batches()
+async def list_batches(client: httpx.AsyncClient = Depends(get_client)):
+    batches = get_all_batches()
+
+    # Get 1 hospital from each non-empty batch to determine active status
+    non_empty = [batch_id for batch_id, hospital_ids in batches.items() if hospital_ids]
+    responses = await gather_bounded(
+        (get_hospital(client, batches[batch_id][0]) for batch_id in non_empty),
+        return_exceptions=True,
+    )
+    # an unreachable upstream is an error, not an inactive batch
+    raise_first_error(responses)
+    first_hospitals = dict(zip(non_empty, responses))
 
     response = []
 
-    async with httpx.AsyncClient() as client:
-        for batch_id, hospital_ids in batches.items():
-            # Get 1 hospital from batch to determine active status
-            active_status = False
+    for batch_id, hospital_ids in batches.items():
+        active_status = False
 
-            if hospital_ids:  # ensure batch not empty
-                first_hid = hospital_ids[0]
-                res = await client.get(f"{RENDER_BASE}/hospitals/{first_hid}")
+        hospital = first_hospitals.get(batch_id)
+        if hospital is not None:
+            active_status = hospital.get("active", False)
 
-                if res.status_code == 200:
-                    hospital = res.json()
-                    active_status = hospital.get("active", False)
-
-            response.append({
-                "batch_id": batch_id,
-                "total_hospitals": len(hospital_ids),
-                "active": active_status,
-            })
+        response.append({
+            "batch_id": batch_id,
+            "total_hospitals": len(hospital_ids),
+            "active": active_status,
+        })
 
     return {"count": len(response), "batches": response}
-
-
-@app.patch("/hospitals/batch/{batch_id}/activate")
-async def deactivate_batch(batch_id: str):
-    """
-    Deactivate batch by calling the same activate endpoint but sending active=false.
-    """
-    payload = {"active": False}
-
-    async with httpx.AsyncClient() as client:
-        res = await client.patch(
-            f"{RENDER_BASE}/hospitals/batch/{batch_id}/activate",
-            json=payload
-        )
-
-    if res.status_code not in (200, 204):
-        raise HTTPException(400, f"Failed to deactivate batch: {res.text}")
-
-    return {"batch_id": batch_id, "deactivated": True}
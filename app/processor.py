@@ -1,98 +1,345 @@
+import codecs
 import csv
-import io
 import time
 import uuid
 import asyncio
-from typing import List, Dict, Tuple
+import random
+from typing import Any, AsyncIterator, List, Dict, Tuple, Optional
 import httpx
+import orjson
 from .config import settings
 from .schemas import HospitalResult
 
-async def parse_csv_bytes(file_bytes: bytes) -> List[Dict]:
+# First-cell values that mark a header row.
+_HEADER_FIRST = frozenset({"name", "hospital_name"})
+
+def _is_header(row: List[str]) -> bool:
+    return bool(row) and row[0].strip().lower() in _HEADER_FIRST
+
+def _row_to_dict(r: List[str]) -> Dict:
+    # allow rows with 2+ columns (name,address,[phone])
+    return {
+        "name": r[0].strip(),
+        "address": r[1].strip() if len(r) > 1 else "",
+        "phone": r[2].strip() if len(r) > 2 else None,
+    }
+
+def _is_blank(r: List[str]) -> bool:
+    return not r or not any(c.strip() for c in r)
+
+def _quote_open_after(line: str, in_quotes: bool) -> bool:
+    """
+    Return whether a quoted field is still open at the end of line, given
+    whether one was open at its start. Follows csv's default dialect: a quote
+    only opens a field at the start of that field, and "" inside a quoted
+    field is an escaped quote.
+    """
+    if not in_quotes and '"' not in line:
+        return False
+    at_field_start = not in_quotes
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if in_quotes:
+            if c == '"':
+                if i + 1 < n and line[i + 1] == '"':
+                    i += 1
+                else:
+                    in_quotes = False
+        elif c == '"' and at_field_start:
+            in_quotes = True
+        at_field_start = not in_quotes and c == ","
+        i += 1
+    return in_quotes
+
+class CSVTooLarge(ValueError):
+    """
+    Raised when the upload or a single record passes the configured size limits.
+    """
+
+class _CSVRowParser:
+    """
+    Incremental CSV parser behind both stream_csv and parse_csv_bytes.
+    feed() takes raw bytes in any chunking and returns the row dicts
+    (keys: name, address, phone) that are complete so far. Accepts files
+    with or without header and skips empty rows.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.partial: List[str] = []    # pieces of the line after the last newline seen
+        self.record: List[str] = []     # lines of a record whose quoted field is still open
+        self.in_quotes = False
+        self.first = True
+
+    def feed(self, chunk: bytes, final: bool = False) -> List[Dict]:
+        # Only the new text is searched for newlines; a line still open is
+        # kept as pieces and joined once, when its newline arrives.
+        pieces = self.decoder.decode(chunk, final=final).split("\n")
+        self.partial.append(pieces[0])
+        if len(pieces) > 1:
+            lines = ["".join(self.partial)] + pieces[1:-1]
+            self.partial = [pieces[-1]]
+        else:
+            lines = []
+
+        # Only whole records go to csv.reader, one line per item like a file.
+        complete: List[str] = []
+        for line in lines:
+            line += "\n"
+            self.record.append(line)
+            self.in_quotes = _quote_open_after(line, self.in_quotes)
+            if not self.in_quotes:
+                complete.extend(self.record)
+                self.record = []
+        if final:
+            rest = "".join(self.partial)
+            if rest:
+                self.record.append(rest)
+            complete.extend(self.record)
+            self.partial = []
+            self.record = []
+
+        # both buffers only ever hold one unfinished record
+        if sum(map(len, self.partial)) + sum(map(len, self.record)) > settings.MAX_CSV_RECORD_BYTES:
+            raise CSVTooLarge(f"CSV record longer than {settings.MAX_CSV_RECORD_BYTES} bytes")
+
+        rows = []
+        for r in csv.reader(complete):
+            if self.first:
+                self.first = False
+                if _is_header(r):
+                    continue
+            if not _is_blank(r):
+                rows.append(_row_to_dict(r))
+        return rows
+
+def parse_csv_bytes(file_bytes: bytes) -> List[Dict]:
     """
     Parse CSV bytes into list of dicts with keys: name, address, phone.
-    Accepts files with or without header. Skips empty rows.
+    Same parser as stream_csv, fed the whole body at once.
     """
-    text = file_bytes.decode("utf-8-sig")
-    reader = csv.reader(io.StringIO(text))
-    rows = list(reader)
+    return _CSVRowParser().feed(file_bytes, final=True)
 
-    # If header appears to be present (first cell equals 'name'), drop it.
-    if rows and rows[0] and rows[0][0].strip().lower() == "name":
-        rows = rows[1:]
+async def stream_csv(file, chunk_size: int = 64 * 1024) -> AsyncIterator[Dict]:
+    """
+    Parse an uploaded CSV incrementally, reading chunk_size bytes at a time,
+    without holding the whole upload in memory. Raises CSVTooLarge past
+    settings.MAX_CSV_BYTES in total or settings.MAX_CSV_RECORD_BYTES
+    buffered for one record.
+    """
+    parser = _CSVRowParser()
+    total = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        total += len(chunk)
+        if total > settings.MAX_CSV_BYTES:
+            raise CSVTooLarge(f"CSV larger than {settings.MAX_CSV_BYTES} bytes")
+        for row in parser.feed(chunk, final=not chunk):
+            yield row
+        if not chunk:
+            break
 
-    parsed = []
-    for row in rows:
-        # allow rows with 2+ columns (name,address,[phone])
-        if not row or all((not c.strip() for c in row)):
-            continue
-        name = row[0].strip() if len(row) > 0 else ""
-        address = row[1].strip() if len(row) > 1 else ""
-        phone = row[2].strip() if len(row) > 2 else None
-        parsed.append({"name": name, "address": address, "phone": phone})
-    return parsed
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+async def _backoff(attempt: int):
+    # exponential backoff with jitter so concurrent retries spread out
+    await asyncio.sleep(random.uniform(0.05, 0.2) * (2 ** attempt))
+
+def batch_payload_tail(batch_id: str) -> bytes:
+    """
+    JSON suffix shared by every row of a batch: the creation_batch_id field
+    plus the closing brace. Built once per upload and appended to each row body.
+    """
+    return b',"creation_batch_id":' + orjson.dumps(batch_id) + b"}"
 
-async def create_hospital(client: httpx.AsyncClient, row_idx: int, row: Dict, batch_id: str) -> HospitalResult:
+async def create_hospital(client: httpx.AsyncClient, row_idx: int, row: Dict, payload_tail: bytes) -> HospitalResult:
     """
     Create a single hospital by calling external API.
+    The row must already have passed validate_rows.
+    payload_tail is batch_payload_tail(batch_id) for the current upload.
     Returns a HospitalResult dataclass instance.
     """
+    name = row["name"]
+    address = row["address"]
+
+    # orjson output always ends with "}", so drop it and add the batch tail
+    body = orjson.dumps({"name": name, "address": address, "phone": row.get("phone") or None})[:-1] + payload_tail
+
+    url = "/hospitals/"
+    error = ""
+    for attempt in range(settings.HTTP_POST_ATTEMPTS):
+        if attempt:
+            await _backoff(attempt)
+        try:
+            resp = await client.post(url, content=body, headers=_JSON_HEADERS)
+        except httpx.PoolTimeout as e:
+            # never sent, safe to retry
+            error = str(e) or "timed out waiting for a connection"
+            continue
+        except Exception as e:
+            return HospitalResult.model_construct(row=row_idx, hospital_id=None, name=name, status="failed", error=str(e))
+
+        if resp.status_code in (200, 201):
+            try:
+                hospital_id = resp.json().get("id")
+            except Exception as e:
+                return HospitalResult.model_construct(row=row_idx, hospital_id=None, name=name, status="failed", error=f"invalid response: {e}")
+            return HospitalResult.model_construct(row=row_idx, hospital_id=hospital_id, name=name, status="created")
+        error = f"HTTP {resp.status_code}: {resp.text}"
+        if 400 <= resp.status_code < 500:
+            # client error, don't retry
+            return HospitalResult.model_construct(row=row_idx, hospital_id=None, name=name, status="failed", error=error)
+        # otherwise treat as transient and retry
+    return HospitalResult.model_construct(row=row_idx, hospital_id=None, name=name, status="failed", error=error)
+
+def validate_rows(rows: List[Dict]) -> Tuple[List[Tuple[int, Dict]], List[HospitalResult]]:
+    """
+    Split rows into (row_idx, row) pairs worth sending upstream and
+    validation_failed results for rows missing a name or address.
+    Row indexes are 1-based.
+    """
+    valid: List[Tuple[int, Dict]] = []
+    invalid: List[HospitalResult] = []
+    for i, row in enumerate(rows, start=1):
+        if row.get("name") and row.get("address"):
+            valid.append((i, row))
+        else:
+            invalid.append(HospitalResult.model_construct(row=i, hospital_id=None, name=row.get("name") or "", status="validation_failed", error="name or address missing"))
+    return valid, invalid
+
+def _bulk_unsupported(status_code: int) -> bool:
+    # No bulk route upstream: a redirect (e.g. trailing-slash 307 that httpx
+    # does not follow), not found, method not allowed or not implemented.
+    return 300 <= status_code < 400 or status_code in (404, 405, 501)
+
+async def create_hospitals_bulk(client: httpx.AsyncClient, rows: List[Tuple[int, Dict]], batch_id: str) -> Optional[List[HospitalResult]]:
+    """
+    Create all (row_idx, row) pairs from validate_rows with a single call to
+    the upstream bulk endpoint. Results are matched to rows by position.
+    5xx responses are retried with the same backoff as create_hospital.
+    Returns None if the upstream has no bulk endpoint, so the caller can
+    fall back to per-row creation.
+    """
     payload = {
-        "name": row.get("name"),
-        "address": row.get("address"),
-        "phone": row.get("phone") or None,
-        "creation_batch_id": batch_id
+        "hospitals": [
+            {"name": row["name"], "address": row["address"], "phone": row.get("phone") or None, "creation_batch_id": batch_id}
+            for _, row in rows
+        ],
+        "batch_id": batch_id,
     }
+    body = orjson.dumps(payload)
 
-    # Basic validation
-    if not payload["name"] or not payload["address"]:
-        return HospitalResult(row=row_idx, hospital_id=None, name=payload["name"] or "", status="validation_failed", error="name or address missing")
+    def all_failed(error: str) -> List[HospitalResult]:
+        return [HospitalResult.model_construct(row=i, hospital_id=None, name=row["name"], status="failed", error=error) for i, row in rows]
 
-    url = f"{settings.HOSPITAL_API_BASE}/hospitals/"
+    error = ""
+    for attempt in range(settings.HTTP_POST_ATTEMPTS):
+        if attempt:
+            await _backoff(attempt)
+        try:
+            resp = await client.post("/hospitals/bulk/", content=body, headers=_JSON_HEADERS)
+        except httpx.PoolTimeout as e:
+            # never sent, safe to retry
+            error = str(e) or "timed out waiting for a connection"
+            continue
+        except Exception as e:
+            return all_failed(str(e))
+
+        if _bulk_unsupported(resp.status_code):
+            return None
+        if resp.status_code in (200, 201):
+            break
+        error = f"HTTP {resp.status_code}: {resp.text}"
+        if resp.status_code < 500:
+            # client error, don't retry
+            return all_failed(error)
+        # otherwise treat as transient and retry
+    else:
+        return all_failed(error)
+
+    # The rows may already exist upstream, so a bad body fails the rows
+    # rather than the whole upload.
     try:
-        # Try twice for transient errors
-        for attempt in range(2):
-            resp = await client.post(url, json=payload, timeout=settings.HTTP_TIMEOUT)
-            if resp.status_code in (200, 201):
-                data = resp.json()
-                return HospitalResult(row=row_idx, hospital_id=data.get("id"), name=payload["name"], status="created")
-            if 400 <= resp.status_code < 500:
-                # client error, don't retry
-                return HospitalResult(row=row_idx, hospital_id=None, name=payload["name"], status="failed", error=f"HTTP {resp.status_code}: {resp.text}")
-            # otherwise treat as transient and retry
-        return HospitalResult(row=row_idx, hospital_id=None, name=payload["name"], status="failed", error=f"HTTP {resp.status_code}: {resp.text}")
+        data = resp.json()
     except Exception as e:
-        return HospitalResult(row=row_idx, hospital_id=None, name=payload["name"], status="failed", error=str(e))
+        return all_failed(f"invalid bulk response: {e}")
+    created = data.get("hospitals") if isinstance(data, dict) else data
+    if not isinstance(created, list):
+        return all_failed("invalid bulk response: no hospitals list")
+
+    results: List[HospitalResult] = []
+    for pos, (i, row) in enumerate(rows):
+        item = created[pos] if pos < len(created) else None
+        if isinstance(item, dict) and item.get("id") is not None:
+            results.append(HospitalResult.model_construct(row=i, hospital_id=item["id"], name=row["name"], status="created"))
+        else:
+            error = item.get("error") if isinstance(item, dict) else None
+            results.append(HospitalResult.model_construct(row=i, hospital_id=None, name=row["name"], status="failed", error=error or "missing from bulk response"))
+    return results
+
+def _retrieve_exception(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
 
-async def process_rows(rows: List[Dict], batch_id: str) -> Tuple[List[HospitalResult], bool, float]:
+async def process_rows(client: httpx.AsyncClient, rows: List[Dict], batch_id: str, state: Optional[Any] = None) -> Tuple[List[HospitalResult], bool, float]:
     """
-    Process the rows concurrently (bounded by settings.CONCURRENCY).
+    Create the rows with one bulk call; if the upstream has no bulk endpoint,
+    fall back to per-row calls run concurrently on the shared client.
+    state (app.state) remembers in bulk_retry_at that the bulk endpoint is
+    missing, so uploads skip the probe for settings.BULK_RETRY_INTERVAL.
     Returns: (results list, activated_bool, processing_time_seconds)
     """
     start = time.time()
-    sem = asyncio.Semaphore(settings.CONCURRENCY)
-    results: List[HospitalResult] = []
+    activate_url = f"/hospitals/batch/{batch_id}/activate"
+    activate_task: Optional[asyncio.Task] = None
+
+    def start_activation():
+        # Activation applies to the batch (creation_batch_id), including rows
+        # created after the PATCH, so a single PATCH can go out as soon as the
+        # first row exists and overlap the remaining POSTs.
+        nonlocal activate_task
+        if activate_task is None:
+            activate_task = asyncio.create_task(client.patch(activate_url))
+            # retrieve the exception even if nobody awaits the task (e.g. wait_for timed out)
+            activate_task.add_done_callback(_retrieve_exception)
+
+    # Invalid rows are answered locally and never become network work.
+    valid, invalid = validate_rows(rows)
+    results: Optional[List[HospitalResult]] = None
+    if not valid:
+        results = []
+    elif time.monotonic() >= getattr(state, "bulk_retry_at", 0.0):
+        results = await create_hospitals_bulk(client, valid, batch_id)
+        if results is None and state is not None:
+            # expire it, so a one-off 404 or redirect doesn't disable bulk for good
+            state.bulk_retry_at = time.monotonic() + settings.BULK_RETRY_INTERVAL
 
-    async with httpx.AsyncClient() as client:
+    if results is None:
+        payload_tail = batch_payload_tail(batch_id)
+
+        # The shared client's pool (and HTTP/2 stream limit) already bounds
+        # how many POSTs are in flight, so no extra semaphore is needed.
         async def worker(i: int, r: Dict):
-            async with sem:
-                return await create_hospital(client, i, r, batch_id)
-        tasks = [asyncio.create_task(worker(i + 1, r)) for i, r in enumerate(rows)]
-        for coro in asyncio.as_completed(tasks):
-            res = await coro
-            results.append(res)
-
-    # Attempt activation if at least one created
-    created_any = any(r.status == "created" for r in results)
+            res = await create_hospital(client, i, r, payload_tail)
+            if res.status == "created":
+                start_activation()
+            return res
+        results = list(await asyncio.gather(*(worker(i, r) for i, r in valid)))
+    elif any(r.status == "created" for r in results):
+        start_activation()
+
     activated = False
-    if created_any:
-        activate_url = f"{settings.HOSPITAL_API_BASE}/hospitals/batch/{batch_id}/activate"
+    if activate_task is not None:
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.patch(activate_url, timeout=settings.HTTP_TIMEOUT)
-                activated = resp.status_code in (200, 204)
+            # Shielded so a client disconnect does not leave created rows inactive.
+            resp = await asyncio.wait_for(asyncio.shield(activate_task), settings.HTTP_TIMEOUT)
+            activated = resp.status_code in (200, 204)
         except Exception:
             activated = False
 
+    results = sorted(results + invalid, key=lambda r: r.row)
+
     processing_time = time.time() - start
     return results, activated, processing_time
@@ -22,3 +22,6 @@ class BulkResponse(BaseModel):
     processing_time_seconds: float
     batch_activated: bool
     hospitals: List[HospitalResult]
+
+class ActivatePayload(BaseModel):
+    active: bool = True
@@ -1,24 +1,18 @@
-import asyncio
 from typing import Dict, List
 
+# In-process batch store. Every access runs on the event loop without an
+# await inside, so plain dict operations are already atomic.
+# For multi-worker deployments move this behind the same functions to Redis.
 _batches: Dict[str, List[str]] = {}
-_lock = asyncio.Lock()
 
-async def save_batch(batch_id: str, hospital_ids: List[str]):
-    async with _lock:
-        _batches[batch_id] = hospital_ids
+def save_batch(batch_id: str, hospital_ids: List[str]):
+    _batches[batch_id] = hospital_ids
 
-async def get_batch(batch_id: str):
-    async with _lock:
-        return _batches.get(batch_id)
+def get_batch(batch_id: str):
+    return _batches.get(batch_id)
 
-async def get_all_batches():
-    async with _lock:
-        return dict(_batches)
+def get_all_batches():
+    return dict(_batches)
 
-async def remove_batch(batch_id: str):
-    async with _lock:
-        if batch_id in _batches:
-            del _batches[batch_id]
-            return True
-        return False
+def remove_batch(batch_id: str):
+    return _batches.pop(batch_id, None) is not None
@@ -1,16 +1,156 @@
+from fastapi import UploadFile
 from fastapi.testclient import TestClient
 from app.main import app
+from app.config import settings
+from app.processor import CSVTooLarge, parse_csv_bytes, stream_csv
+import asyncio
+import csv
+import gzip
 import io
+import httpx
+import pytest
 
-client = TestClient(app)
 
-def test_root():
+@pytest.fixture
+def client():
+    # Enter the lifespan so the shared upstream client is created.
+    with TestClient(app) as c:
+        yield c
+
+def test_root(client):
     r = client.get("/")
     assert r.status_code == 200
     assert r.json()["message"].startswith("Hospital Bulk API")
 
-def test_upload_csv_success():
+def test_upload_csv_success(client):
     csv_data = "name,address,phone\nApollo Hospital,Mumbai,9999999999\nAIIMS,Delhi,8888888888\n"
     files = {"file": ("hosp.csv", csv_data, "text/csv")}
     r = client.post("/hospitals/bulk/upload", files=files)
     assert r.status_code in (200, 400, 502, 504, 500)
+
+def test_parse_csv_bytes_header_and_blank_rows():
+    data = b"\xef\xbb\xbfname,address,phone\n Apollo , Mumbai ,999\n\n,,\nAIIMS,Delhi\n"
+    assert parse_csv_bytes(data) == [
+        {"name": "Apollo", "address": "Mumbai", "phone": "999"},
+        {"name": "AIIMS", "address": "Delhi", "phone": None},
+    ]
+
+def test_parse_csv_bytes_without_header():
+    assert parse_csv_bytes(b"Apollo,Mumbai,999\n") == [
+        {"name": "Apollo", "address": "Mumbai", "phone": "999"},
+    ]
+    assert parse_csv_bytes(b"") == []
+
+def collect_stream(data, chunk_size):
+    async def collect():
+        upload = UploadFile(file=io.BytesIO(data))
+        return [row async for row in stream_csv(upload, chunk_size=chunk_size)]
+    return asyncio.run(collect())
+
+@pytest.mark.parametrize("data", [
+    'name,address,phone\n"Apollo, Main","Line 1\nMumbai",999\n\nमैक्स,Delhi\r\n'.encode("utf-8-sig"),
+    # stray quote inside an unquoted field is a literal character
+    b'name,address\n12" Clinic,Mumbai\nB,C\n',
+    # even quote count while a quoted field is really open
+    b'a"b,"c\nd",e\nf,g\n',
+    b'"say ""hi""\nthere",x\ny,z',
+    # only "\n" ends a line, not the other str.splitlines separators
+    'Apollo\u2028Main,Mumbai\nA\x1cB,C\x0cD\n'.encode(),
+])
+@pytest.mark.parametrize("chunk_size", [1, 3, 64 * 1024])
+def test_stream_csv_matches_stdlib_csv(data, chunk_size):
+    # stdlib csv over the whole text is the reference the chunked parser must match
+    reference = [r for r in csv.reader(io.StringIO(data.decode("utf-8-sig"))) if any(c.strip() for c in r)]
+    if reference and reference[0][0].strip().lower() == "name":
+        reference = reference[1:]
+    expected = [
+        {"name": r[0].strip(), "address": r[1].strip() if len(r) > 1 else "", "phone": r[2].strip() if len(r) > 2 else None}
+        for r in reference
+    ]
+    # tiny chunks split multi-byte characters and quoted newlines
+    assert collect_stream(data, chunk_size) == expected
+    assert parse_csv_bytes(data) == expected
+
+def test_stream_csv_quoted_newline_and_stray_quote():
+    data = 'name,address\n"Apollo","Line 1\nMumbai"\n12" Clinic,Pune\n'.encode()
+    assert collect_stream(data, 3) == [
+        {"name": "Apollo", "address": "Line 1\nMumbai", "phone": None},
+        {"name": '12" Clinic', "address": "Pune", "phone": None},
+    ]
+
+def test_upload_with_stray_quote(client, monkeypatch):
+    upstream = httpx.AsyncClient(
+        base_url="http://upstream",
+        transport=httpx.MockTransport(lambda req: httpx.Response(201, json={"hospitals": [{"id": 1}, {"id": 2}]})),
+    )
+    monkeypatch.setattr(app.state, "client", upstream)
+    files = {"file": ("hosp.csv", 'name,address\n12" Clinic,Mumbai\nB,C\n', "text/csv")}
+    r = client.post("/hospitals/bulk/upload", files=files)
+    assert r.status_code == 200
+    assert [h["name"] for h in r.json()["hospitals"]] == ['12" Clinic', "B"]
+
+def test_parse_csv_bytes_hospital_name_header():
+    assert parse_csv_bytes(b"Hospital_Name,address\nApollo,Mumbai\n") == [
+        {"name": "Apollo", "address": "Mumbai", "phone": None},
+    ]
+
+def test_parse_csv_bytes_keeps_unicode_line_separators():
+    assert parse_csv_bytes('Apollo\u2028Main,Mumbai\n'.encode()) == [
+        {"name": "Apollo\u2028Main", "address": "Mumbai", "phone": None},
+    ]
+
+class ByteStream(httpx.AsyncByteStream):
+    # a real network stream, so the proxy's aiter_raw() can consume it
+    def __init__(self, data):
+        self.data = data
+
+    async def __aiter__(self):
+        yield self.data
+
+def mock_hospital_list(monkeypatch, status=200):
+    body = b'[{"id":1,"name":"Apollo"}]'
+
+    def handler(req):
+        # gzip only when asked, like a real server
+        if "gzip" in req.headers.get("accept-encoding", ""):
+            return httpx.Response(status, stream=ByteStream(gzip.compress(body)), headers={"content-type": "application/json", "content-encoding": "gzip"})
+        return httpx.Response(status, stream=ByteStream(body), headers={"content-type": "application/json"})
+
+    upstream = httpx.AsyncClient(base_url="http://upstream", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(app.state, "client", upstream)
+    return body
+
+def test_list_hospitals_honours_client_accept_encoding(client, monkeypatch):
+    body = mock_hospital_list(monkeypatch)
+
+    r = client.get("/hospitals", headers={"accept-encoding": "identity"})
+    assert r.status_code == 200
+    assert "content-encoding" not in r.headers
+    assert r.content == body
+
+    r = client.get("/hospitals", headers={"accept-encoding": "gzip"})
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.json() == [{"id": 1, "name": "Apollo"}]
+
+def test_list_hospitals_passes_upstream_status(client, monkeypatch):
+    mock_hospital_list(monkeypatch, status=503)
+    r = client.get("/hospitals")
+    assert r.status_code == 503
+    assert r.headers["content-type"] == "application/json"
+
+@pytest.mark.parametrize("data", [
+    # one line that never ends
+    b"A" * (settings.MAX_CSV_RECORD_BYTES + 1),
+    # a quoted field that never closes
+    b'"' + b"A\n" * settings.MAX_CSV_RECORD_BYTES,
+    # blank lines never count as rows, so only the byte limit stops them
+    b"\n" * (settings.MAX_CSV_BYTES + 1),
+])
+def test_stream_csv_rejects_unbounded_buffering(data):
+    with pytest.raises(CSVTooLarge):
+        collect_stream(data, 64 * 1024)
+
+def test_upload_too_large_is_rejected(client):
+    files = {"file": ("hosp.csv", b"A" * (settings.MAX_CSV_RECORD_BYTES + 1), "text/csv")}
+    r = client.post("/hospitals/bulk/upload", files=files)
+    assert r.status_code == 400
@@ -0,0 +1,157 @@
+from types import SimpleNamespace
+import asyncio
+import time
+import httpx
+import orjson
+import pytest
+from app.processor import process_rows
+
+ROWS = [
+    {"name": "Apollo", "address": "Mumbai", "phone": "999"},
+    {"name": "", "address": "Pune", "phone": None},
+    {"name": "AIIMS", "address": "Delhi", "phone": None},
+]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr("app.processor.random.uniform", lambda a, b: 0)
+
+
+def upstream(bulk_statuses=()):
+    """
+    Mock Render backend. Each bulk POST consumes the next status from
+    bulk_statuses (the last one repeats); 201 answers with created ids.
+    Returns (client, calls) where calls records (method, path).
+    """
+    calls = []
+    statuses = list(bulk_statuses)
+    next_id = iter(range(100, 200))
+
+    def handler(req: httpx.Request):
+        calls.append((req.method, req.url.path))
+        if req.url.path == "/hospitals/bulk/":
+            status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+            if status == 201:
+                body = orjson.loads(req.content)
+                return httpx.Response(201, json={"hospitals": [{"id": next(next_id)} for _ in body["hospitals"]]})
+            return httpx.Response(status)
+        if req.method == "POST":
+            return httpx.Response(201, json={"id": next(next_id)})
+        return httpx.Response(204)
+
+    return httpx.AsyncClient(base_url="http://upstream", transport=httpx.MockTransport(handler)), calls
+
+
+def run(client, state=None):
+    async def go():
+        async with client:
+            return await process_rows(client, ROWS, "batch-1", state)
+    return asyncio.run(go())
+
+
+def test_bulk_success():
+    client, calls = upstream([201])
+    results, activated, _ = run(client)
+    assert [(r.row, r.status) for r in results] == [(1, "created"), (2, "validation_failed"), (3, "created")]
+    assert activated
+    assert calls.count(("POST", "/hospitals/bulk/")) == 1
+    assert ("POST", "/hospitals/") not in calls
+
+
+@pytest.mark.parametrize("status", [307, 404, 405, 501])
+def test_bulk_unsupported_falls_back_and_is_remembered(status):
+    state = SimpleNamespace(bulk_retry_at=0.0)
+    client, calls = upstream([status])
+    results, activated, _ = run(client, state)
+    assert [(r.row, r.status) for r in results] == [(1, "created"), (2, "validation_failed"), (3, "created")]
+    assert activated
+    assert calls.count(("POST", "/hospitals/")) == 2
+    assert state.bulk_retry_at > time.monotonic()
+
+    client, calls = upstream([status])
+    run(client, state)
+    assert ("POST", "/hospitals/bulk/") not in calls
+
+
+def test_bulk_unsupported_flag_expires():
+    state = SimpleNamespace(bulk_retry_at=time.monotonic() - 1)
+    client, calls = upstream([201])
+    results, _, _ = run(client, state)
+    assert calls.count(("POST", "/hospitals/bulk/")) == 1
+    assert results[0].status == "created"
+
+
+@pytest.mark.parametrize("body", [
+    b"<html>catch-all</html>",
+    b'{"detail": "ok"}',
+    b'{"hospitals": "nope"}',
+])
+def test_bulk_unreadable_success_body_fails_the_rows(body):
+    def handler(req: httpx.Request):
+        if req.url.path == "/hospitals/bulk/":
+            return httpx.Response(200, content=body)
+        return httpx.Response(204)
+
+    client = httpx.AsyncClient(base_url="http://upstream", transport=httpx.MockTransport(handler))
+    results, activated, _ = run(client)
+    assert [r.status for r in results] == ["failed", "validation_failed", "failed"]
+    assert results[0].error.startswith("invalid bulk response")
+    assert not activated
+
+
+def test_bulk_5xx_is_retried():
+    client, calls = upstream([503, 502, 201])
+    results, activated, _ = run(client)
+    assert [r.status for r in results] == ["created", "validation_failed", "created"]
+    assert activated
+    assert calls.count(("POST", "/hospitals/bulk/")) == 3
+
+
+def test_bulk_5xx_exhausted_fails_rows():
+    client, calls = upstream([503])
+    results, activated, _ = run(client)
+    assert [r.status for r in results] == ["failed", "validation_failed", "failed"]
+    assert results[0].error.startswith("HTTP 503")
+    assert not activated
+    assert ("POST", "/hospitals/") not in calls
+
+
+def test_activation_overlaps_remaining_posts():
+    # The second row's POST only answers once the activation PATCH has
+    # arrived, so this deadlocks (and times out) unless they overlap.
+    patched = asyncio.Event()
+    calls = []
+
+    async def handler(req: httpx.Request):
+        calls.append((req.method, req.url.path))
+        if req.url.path == "/hospitals/bulk/":
+            return httpx.Response(404)
+        if req.method == "PATCH":
+            patched.set()
+            return httpx.Response(204)
+        if orjson.loads(req.content)["name"] == "AIIMS":
+            await asyncio.wait_for(patched.wait(), 1)
+        return httpx.Response(201, json={"id": len(calls)})
+
+    client = httpx.AsyncClient(base_url="http://upstream", transport=httpx.MockTransport(handler))
+    results, activated, _ = run(client)
+    assert [r.status for r in results] == ["created", "validation_failed", "created"]
+    assert activated
+    assert [c for c in calls if c[0] == "PATCH"] == [("PATCH", "/hospitals/batch/batch-1/activate")]
+
+
+@pytest.mark.parametrize("body", [b"created", b"[1, 2]"])
+def test_per_row_unreadable_success_body_fails_the_row(body):
+    def handler(req: httpx.Request):
+        if req.url.path == "/hospitals/bulk/":
+            return httpx.Response(404)
+        if req.method == "POST":
+            return httpx.Response(201, content=body)
+        return httpx.Response(204)
+
+    client = httpx.AsyncClient(base_url="http://upstream", transport=httpx.MockTransport(handler))
+    results, activated, _ = run(client)
+    assert [r.status for r in results] == ["failed", "validation_failed", "failed"]
+    assert results[0].error.startswith("invalid response")
+    assert not activated